@@ -1,63 +1,187 @@
-import re
 import ast
+import functools
+import os
+import re
 import textwrap
+from typing import List, Optional, Sequence, Tuple
+
+
+# Setting SNAKECHARMER_DEBUG in the environment lets unhandled-node
+# errors propagate instead of silently returning the input untouched, so
+# that missing handlers get noticed and fixed.
+DEBUG = bool(os.environ.get('SNAKECHARMER_DEBUG'))
+
+
+class UnhandledNodeError(Exception):
+    """
+    Raised when the formatter meets a node type it has no handler for.
+
+    """
+
+
+# One shared TextWrapper for all comment filling. wrap() and fill()
+# construct a fresh instance, regexes and all, on every single call; the
+# formatter only ever runs in Vim's single-threaded pythonx context, so
+# reconfiguring one instance per call is safe and much cheaper. Keeping
+# long words whole also spares textwrap its slowest chunking regex.
+_WRAPPER = textwrap.TextWrapper(
+    break_on_hyphens=False,
+    break_long_words=False,
+)
+
+# A single assignment or bare call with flat arguments. Lines shaped like
+# this are common enough to deserve a path that skips the parser; anything
+# nested or quoted falls through to the real formatter.
+_SIMPLE_CALL = re.compile(
+    r'^((?:\w+(?:, *\w+)* *= *)?\w+)'
+    r'\(([^()\[\]{}\'"]*)\)$'
+)
+
+
+class Formatter(ast.NodeVisitor):
+    # Width handlers wrap against; parse() sets it before every walk.
+    width = 79
 
+    # Handler cache keyed on the node type object itself. Resolving the
+    # visit_* name costs a string build and a getattr; doing it once per
+    # type and hitting this dict afterwards makes dispatch a single
+    # hash lookup on the type.
+    _dispatch = {}
 
-class Formatter(object):
-    def format(self, lines, width=79):
+    def format(self, lines: List[str], width: int = 79) -> List[str]:
         """
         The main executor function. Takes all lines, formats them and returns
         the result.
 
         """
 
+        # Fast path: a single line that already fits and contains nothing
+        # that could be split or joined does not need to be parsed at all.
+        # Strict, like the length checks in the handlers.
+        if len(lines) == 1 and len(lines[0]) < width and \
+                not any(c in lines[0] for c in '=({[,'):
+            return lines
+
         try:
             ret = []
-            blocks = [[]]
-            comment = False
-            comment_block = False
             data, indent = self.unindent(lines)
 
             # If the indentation changed, we need to consider this for length
             # calculations.
             width -= indent
 
-            for line in data:
-                comment = line.startswith('#')
-                comment_block = blocks[-1] and blocks[-1][0].startswith('#')
-
-                # If we are switching context (last line was comment, next one
-                # is not, or vice versa), we need to create a new block.
-                if blocks[-1] != [] and comment != comment_block:
-                    blocks.append([])
-                blocks[-1].append(line)
-
-            for block in blocks:
-                if block[0].startswith('#'):
-                    ret += self.format_comments("# ", block, width)
-                else:
-                    try:
-                        root = ast.parse('\n'.join(block))
-
-                        for node in root.body:
-                            ret += self.parse(node, width)
-                    except SyntaxError:
-                        # If there is a syntax error in the code, we can assume
-                        # that the code is not actually code, but a paragraph
-                        # of text inside a docstring or similar. Format as
-                        # a comment but without trailing comment symbols.
-                        ret += self.format_comments("", block, width)
+            if len(data) == 1:
+                # Screen for the simple call shape before paying for a
+                # full parse.
+                simple = self._format_simple_call(data[0], width)
+                if simple is not None:
+                    return self.reindent(simple, indent)
+
+            if not any(line.startswith('#') for line in data):
+                # No comments anywhere means there is only one block. Hand
+                # the lines over directly, without any block bookkeeping.
+                ret += self.format_block(data, width)
+            else:
+                # Only record where the blocks start: an index append per
+                # context switch (last line was comment, next one is not,
+                # or vice versa) beats a list append per line, and slicing
+                # the data afterwards is one copy per block.
+                starts = [0]
+                comment_block = data[0][:1] == '#'
+                for i, line in enumerate(data):
+                    is_comment = line[:1] == '#'
+                    if is_comment != comment_block:
+                        starts.append(i)
+                        comment_block = is_comment
+                starts.append(len(data))
+
+                for a, b in zip(starts, starts[1:]):
+                    ret += self.format_block(data[a:b], width)
 
             ret = self.reindent(ret, indent)
 
-        except Exception:
+        except UnhandledNodeError:
+            if DEBUG:
+                raise
+            ret = lines
+        except (SyntaxError, AttributeError, IndexError, TypeError,
+                ValueError):
             # If something goes wrong, return the original as it was. Be nice
-            # to the user.
+            # to the user. These are the failures the pipeline is known to
+            # produce: syntax and indentation errors from the parser, missing
+            # attributes on node shapes we do not understand, and nested
+            # nodes that refuse to fit on one line.
             ret = lines
 
         return ret
 
-    def format_comments(self, token, lines, width):
+    def format_block(
+        self, block: Sequence[str], width: int
+    ) -> Sequence[str]:
+        """
+        Format one block of lines, dispatching on whether it is a comment
+        block or a code block.
+
+        """
+
+        if block[0][:1] == '#':
+            return _format_comments_cached("# ", tuple(block), width)
+
+        try:
+            return _format_block_cached('\n'.join(block), width)
+        except SyntaxError:
+            # If there is a syntax error in the code, we can assume that the
+            # code is not actually code, but a paragraph of text inside
+            # a docstring or similar. Format as a comment but without
+            # trailing comment symbols.
+            return _format_comments_cached("", tuple(block), width)
+
+    def _format_simple_call(
+        self, line: str, width: int
+    ) -> Optional[List[str]]:
+        """
+        Fast path for lines shaped like `x = foo(a, b)`.
+
+        Splits the arguments on commas directly instead of building an
+        entire syntax tree. Returns None when the line does not match the
+        shape, handing it over to the real formatter.
+
+        """
+
+        match = _SIMPLE_CALL.match(line)
+        if not match:
+            return None
+
+        # Strict comparison, matching _fits() so that the same line
+        # overflows at the same width on both paths.
+        if len(line) < width:
+            return [line]
+
+        args = [arg.strip() for arg in match.group(2).split(',')]
+
+        ret = [
+            f'{match.group(1)}(',
+            *(f'    {arg},' for arg in args if arg),
+            ')',
+        ]
+
+        # The comma split cannot tell a bare generator expression from
+        # plain arguments, and reassembling one with a trailing comma is
+        # a SyntaxError. Only hand back rebuilt code that still compiles;
+        # everything else goes to the real formatter.
+        try:
+            compile(
+                '\n'.join(ret), '<snakecharmer>', 'exec', ast.PyCF_ONLY_AST,
+                dont_inherit=True,
+            )
+        except SyntaxError:
+            return None
+
+        return ret
+
+    def format_comments(
+        self, token: str, lines: Sequence[str], width: int
+    ) -> List[str]:
         """
         Format comments. This uses the `textwrap` stdlib module. It removes the
         `token` from the beginning of all lines, formats according to `width`
@@ -65,23 +189,29 @@ class Formatter(object):
 
         """
 
-        # Clear the existing comment symbols
-        # TODO: Re to catch "#" and not just "# "
+        # Clear the existing comment symbols from the beginning of the
+        # lines only; replace() would also eat matches inside the text.
+        # Lines with a bare "#" and no trailing space are handled as well.
+        data = lines
         if token:
-            lines = [x.replace(token, '') for x in lines]
+            tlen = len(token)
+            data = [
+                x[tlen:] if x.startswith(token) else x.lstrip('#').lstrip(' ')
+                for x in lines
+            ]
 
-        # Actually do the filling
-        ret = textwrap.fill(
-            '\n'.join(lines),
-            width=width,
-            initial_indent=token,
-            subsequent_indent=token,
-        )
+        # Actually do the filling, reusing the module wrapper instead of
+        # having textwrap build a new one for every call.
+        _WRAPPER.width = width
+        _WRAPPER.initial_indent = token
+        _WRAPPER.subsequent_indent = token
+        ret = _WRAPPER.wrap('\n'.join(data))
 
-        # Join them back and return them
-        return ret.split('\n')
+        # Comments without any text wrap into nothing at all; keep the
+        # original lines rather than deleting them.
+        return ret or list(lines)
 
-    def unindent(self, lines):
+    def unindent(self, lines: List[str]) -> Tuple[List[str], int]:
         """
         Remove indentation from the lines.
 
@@ -93,14 +223,21 @@ class Formatter(object):
 
         """
 
-        indent = re.search('\S', lines[0]).start()
+        stripped = lines[0].lstrip()
+        if not stripped:
+            # A first line of pure whitespace says nothing about the
+            # indentation of the block. Give up and let the safety net in
+            # format() return the input untouched.
+            raise IndentationError('whitespace-only first line')
+
+        indent = len(lines[0]) - len(stripped)
         if indent == 0:
             return lines, indent
 
         lines = [s[indent:] for s in lines]
         return lines, indent
 
-    def reindent(self, lines, indent):
+    def reindent(self, lines: List[str], indent: int) -> List[str]:
         """
         Re-apply the indentation that was removed.
 
@@ -108,39 +245,92 @@ class Formatter(object):
 
         if indent == 0:
             return lines
-        return ['{0}{1}'.format(' ' * indent, s) for s in lines]
 
-    def parse(self, node, width):
+        # Build the padding once instead of once per line.
+        pad = ' ' * indent
+        return [pad + s for s in lines]
+
+    def parse(self, node: ast.AST, width: int) -> List[str]:
         """
         Determine what to do with a node.
 
-        Raises an Exception if no handler method is defined.
+        Dispatches through the stdlib NodeVisitor machinery, whose visit_*
+        convention matches the node class names directly. The visitor only
+        passes the node along, so the width travels on the instance.
+
+        """
+
+        self.width = width
+        return self.visit(node)
+
+    def visit(self, node: ast.AST) -> List[str]:
+        """
+        Dispatch a node to its handler, keyed on the node type object.
+
+        NodeVisitor.visit rebuilds the method name and resolves it with
+        getattr for every single node; the memoized resolution makes
+        repeat visits a dict hit instead.
+
+        """
+
+        func = self._dispatch.get(type(node))
+        if func is None:
+            name = f'visit_{type(node).__name__}'
+            func = getattr(Formatter, name, Formatter.generic_visit)
+            self._dispatch[type(node)] = func
+        return func(self, node)
+
+    def generic_visit(self, node: ast.AST) -> List[str]:
+        """
+        Called for nodes without a visit_* handler defined.
+
+        """
+
+        raise UnhandledNodeError(f'Unhandled node {node}')
 
+    def _inline(self, node: ast.AST) -> str:
         """
+        Parse a node that has to fit on a single line.
 
-        cls = node.__class__.__name__.lower()
-        func = getattr(self, 'handle_{0}'.format(cls), None)
-        if func:
-            return func(node, width)
+        Gives up on nodes that came back split over several lines, so that
+        the safety net in format() leaves the input alone instead of
+        truncating it.
 
-        raise Exception('Unhandled node {0}'.format(node))  # pragma: nocover
+        """
+
+        ret = self.visit(node)
+        if len(ret) > 1:
+            raise ValueError('nested node does not fit on one line')
+        return ret[0]
 
-    def handle_assign(self, node, width):
+    def _fits(self, items: Sequence[str], overhead: int) -> bool:
+        """
+        Check whether the items, joined with ', ' and wrapped in overhead
+        extra characters, would fit within the width. Saves building the
+        joined string on the overflow path, which does not need it.
+
+        """
+
+        total = sum(len(item) for item in items) + 2 * max(len(items) - 1, 0)
+        return total + overhead < self.width
+
+    def visit_Assign(self, node: ast.AST) -> List[str]:
         """
         x = y
 
-        A simple assignment. Will run self.parse on the y part.
+        A simple assignment. Will run the visitor on the y part.
 
         """
 
         targets = ', '.join(t.id for t in node.targets)
-        value = self.parse(node.value, width)
+        value = self.visit(node.value)
 
-        ret = ['{0} = {1}'.format(targets, value[0])]
-        ret += value[1:]
-        return ret
+        # visit() handed us a fresh list, so the assignment can be glued
+        # onto its first line in place instead of copying the tail.
+        value[0] = f'{targets} = {value[0]}'
+        return value
 
-    def handle_call(self, node, width):
+    def visit_Call(self, node: ast.AST) -> List[str]:
         """
         function()
 
@@ -150,29 +340,38 @@ class Formatter(object):
         """
 
         func = node.func.id
-        args = []
-        if node.args:
-            args += [self.parse(a, width) for a in node.args]
-        if node.keywords:
-            args += [self.handle_keyword(a, width) for a in node.keywords]
+
+        # Arguments are single lines in the overwhelmingly common case;
+        # _inline() gives us the flat strings directly and punts on anything
+        # that split, so no nested lists are built here.
+        args = [self._inline(a) for a in node.args]
+        for keyword in node.keywords:
+            args += self.visit_keyword(keyword)
 
         if node.starargs:
-            args += self._handle_stars('*', node.starargs, width)
+            args += self._handle_stars('*', node.starargs)
         if node.kwargs:
-            args += self._handle_stars('**', node.kwargs, width)
+            args += self._handle_stars('**', node.kwargs)
 
-        line = '{0}({1})'.format(func, ', '.join(args))
-        if len(line) < width:
+        if self._fits(args, len(func) + 2):
             # Line fits. Send it.
-            return [line]
+            return [f'{func}({", ".join(args)})']
 
-        ret = ['{0}('.format(func)]
-        ret += ['    {0},'.format(arg) for arg in args]
-        ret.append(')')
+        return [f'{func}(', *(f'    {arg},' for arg in args), ')']
 
-        return ret
+    def visit_Constant(self, node: ast.AST) -> List[str]:
+        """
+        Any literal, on Pythons where Num, Str and NameConstant all fold
+        into Constant. Routes on the value the node carries.
 
-    def handle_num(self, node, width):
+        """
+
+        value = node.value
+        if isinstance(value, str):
+            return [f'"{value}"']
+        return [str(value)]
+
+    def visit_Num(self, node: ast.AST) -> List[str]:
         """
         1
 
@@ -180,9 +379,9 @@ class Formatter(object):
 
         """
 
-        return str(node.n)
+        return [str(node.n)]
 
-    def handle_nameconstant(self, node, width):
+    def visit_NameConstant(self, node: ast.AST) -> List[str]:
         """
         True
 
@@ -190,21 +389,21 @@ class Formatter(object):
 
         """
 
-        return str(node.value)
+        return [str(node.value)]
 
-    def handle_expr(self, node, width):
+    def visit_Expr(self, node: ast.AST) -> List[str]:
         """
         Handle any kind of expression that is not an assignment. Just parse it.
 
         """
 
-        return self.parse(node.value, width)
+        return self.visit(node.value)
 
-    def handle_dict(self, node, width):
+    def visit_Dict(self, node: ast.AST) -> List[str]:
         """
         {"key": Value}
 
-        Parse a dictionary. Will run parse on both keys and values.
+        Parse a dictionary. Will run the visitor on keys and values.
         Will not sort the keys.
 
         """
@@ -215,24 +414,16 @@ class Formatter(object):
         items = []
         for key, value in zip(node.keys, node.values):
             items.append(
-                '{0}: {1}'.format(
-                    self.parse(key, width),
-                    self.parse(value, width)
-                )
+                f'{self._inline(key)}: {self._inline(value)}'
             )
 
-        line = '{{{0}}}'.format(', '.join(items))
-        if len(line) < width:
+        if self._fits(items, 2):
             # Line fits. Send it.
-            return [line]
-
-        ret = ['{']
-        ret += ['    {0},'.format(item) for item in items]
-        ret.append('}')
+            return [f'{{{", ".join(items)}}}']
 
-        return ret
+        return ['{', *(f'    {item},' for item in items), '}']
 
-    def handle_str(self, node, width):
+    def visit_Str(self, node: ast.AST) -> List[str]:
         """
         "hehe"
 
@@ -241,9 +432,9 @@ class Formatter(object):
         """
 
         # TODO: Single or double? Raw strings?
-        return '"{0}"'.format(node.s)
+        return [f'"{node.s}"']
 
-    def handle_name(self, node, width):
+    def visit_Name(self, node: ast.AST) -> List[str]:
         """
         x
 
@@ -251,19 +442,19 @@ class Formatter(object):
 
         """
 
-        return "{0}".format(node.id)
+        return [node.id]
 
-    def handle_list(self, node, width):
+    def visit_List(self, node: ast.AST) -> List[str]:
         # TODO: .ctx?
-        return self._handle_iterable('[]', node.elts, width)
+        return self._handle_iterable('[]', node.elts)
 
-    def handle_tuple(self, node, width):
-        return self._handle_iterable('()', node.elts, width)
+    def visit_Tuple(self, node: ast.AST) -> List[str]:
+        return self._handle_iterable('()', node.elts)
 
-    def handle_set(self, node, width):
-        return self._handle_iterable('{}', node.elts, width)
+    def visit_Set(self, node: ast.AST) -> List[str]:
+        return self._handle_iterable('{}', node.elts)
 
-    def handle_importfrom(self, node, width):
+    def visit_ImportFrom(self, node: ast.AST) -> List[str]:
         """
         from module import item
 
@@ -273,7 +464,7 @@ class Formatter(object):
 
         return self._handle_import(node, module=node.module)
 
-    def handle_import(self, node, width):
+    def visit_Import(self, node: ast.AST) -> List[str]:
         """
         import item
 
@@ -282,38 +473,36 @@ class Formatter(object):
         """
         return self._handle_import(node)
 
-    def handle_keyword(self, node, width):
+    def visit_keyword(self, node: ast.AST) -> List[str]:
         """
         x=y
 
         Keyword assignments to calls. Has separate logic since it should not
-        have spaces. Will run self.parse on y.
+        have spaces. Will run the visitor on y.
 
         """
 
-        return '{0}={1}'.format(node.arg, self.parse(node.value, width))
+        return [f'{node.arg}={self._inline(node.value)}']
 
-    def _handle_stars(self, token, items, width):
+    def _handle_stars(self, token: str, items: ast.AST) -> List[str]:
         """
         Handle parsing of starargs and starkwargs in function calls.
 
         """
 
-        args = []
-        targets = self.parse(items, width)
+        targets = self.visit(items)
 
-        if isinstance(targets, list):
-            args.append('{0}{1}'.format(token, targets[0]))
-            if len(targets) > 1:
-                # The x[:-1] is to remove the comma that the parser added.
-                args += [x[:-1] for x in targets[1:-1]]
-                args.append(targets[-1])
-        else:
-            args.append('{0}{1}'.format(token, targets))
+        # The list is fresh from visit(), so star the first line and strip
+        # the commas the parser added in place rather than rebuilding it.
+        targets[0] = f'{token}{targets[0]}'
+        for i in range(1, len(targets) - 1):
+            targets[i] = targets[i][:-1]
 
-        return args
+        return targets
 
-    def _handle_iterable(self, tokens, items, width):
+    def _handle_iterable(
+        self, tokens: str, items: Sequence[ast.AST]
+    ) -> List[str]:
         """
         Handle a iterable, such as a list or a tuple.
 
@@ -322,19 +511,16 @@ class Formatter(object):
         if not items:
             return [tokens]
 
-        items = [self.parse(x, width) for x in items]
-        line = '{1}{0}{2}'.format(', '.join(items), *tokens)
-        if len(line) < width:
+        items = [self._inline(x) for x in items]
+        if self._fits(items, len(tokens)):
             # Line fits. Send it.
-            return [line]
+            return [f'{tokens[0]}{", ".join(items)}{tokens[1]}']
 
-        ret = [tokens[0]]
-        ret += ['    {0},'.format(item) for item in items]
-        ret.append(tokens[1])
+        return [tokens[0], *(f'    {item},' for item in items), tokens[1]]
 
-        return ret
-
-    def _handle_import(self, node, module=None):
+    def _handle_import(
+        self, node: ast.AST, module: Optional[str] = None
+    ) -> List[str]:
         """
         Handle both kinds of import statements.
 
@@ -344,10 +530,56 @@ class Formatter(object):
         for name in node.names:
             imp = name.name
             if name.asname:
-                imp = '{0} as {1}'.format(imp, name.asname)
+                imp = f'{imp} as {name.asname}'
 
             mod = ''
             if module:
-                mod = 'from {0} '.format(module)
-            ret.append('{mod}import {imp}'.format(imp=imp, mod=mod))
+                mod = f'from {module} '
+            ret.append(f'{mod}import {imp}')
         return ret
+
+
+# The cached helpers live at module level so that the keys are only the
+# text and the width; caching on methods would drag every Formatter
+# instance into the keys, never hitting across instances and keeping
+# them alive in the cache. One shared worker does the cached formatting:
+# the class holds no state beyond the width, which parse() resets on
+# every walk.
+_FORMATTER = Formatter()
+
+
+@functools.lru_cache(maxsize=256)
+def _format_block_cached(text: str, width: int) -> Tuple[str, ...]:
+    """
+    Parse and format one block of code.
+
+    Vim tends to ask for the same region over and over again, so the
+    results are memoized on the block text and the width. SyntaxErrors
+    are not cached and will be raised on every call.
+
+    """
+
+    # This is what ast.parse() does under the hood, minus the wrapper
+    # that redoes its feature-flag bookkeeping on every call.
+    root = compile(
+        text, '<snakecharmer>', 'exec', ast.PyCF_ONLY_AST,
+        dont_inherit=True,
+    )
+
+    ret = []
+    for node in root.body:
+        ret += _FORMATTER.parse(node, width)
+    return tuple(ret)
+
+
+@functools.lru_cache(maxsize=256)
+def _format_comments_cached(
+    token: str, lines: Tuple[str, ...], width: int
+) -> Tuple[str, ...]:
+    """
+    Memoizing wrapper around format_comments(). Takes the lines as a
+    tuple so that they can be used as a cache key.
+
+    """
+
+    return tuple(_FORMATTER.format_comments(token, lines, width))
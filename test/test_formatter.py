@@ -1,6 +1,7 @@
 import mock
+import pytest
 
-from pythonx.formatter import Formatter
+from pythonx.formatter import Formatter, UnhandledNodeError
 
 
 class BaseTest(object):
@@ -313,14 +314,24 @@ class TestCrash(BaseTest):
             'baz',
         ]
 
-    @mock.patch('ast.parse')
+    @mock.patch('pythonx.formatter.compile', create=True)
     def test_exception_handling(self, parse):
-        parse.side_effect = Exception()
+        parse.side_effect = AttributeError()
 
         ret = self.form.format(['unisonic', 'never too late'])
 
         assert ret == ['unisonic', 'never too late']
 
+    def test_unhandled_node_returns_input(self):
+        ret = self.form.format(['del x, y'])
+
+        assert ret == ['del x, y']
+
+    @mock.patch('pythonx.formatter.DEBUG', True)
+    def test_unhandled_node_propagates_in_debug(self):
+        with pytest.raises(UnhandledNodeError):
+            self.form.format(['del x, y'])
+
 
 class TestComments(BaseTest):
     def test_below_length(self):